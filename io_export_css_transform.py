@@ -32,11 +32,26 @@ bl_info = {
 import os
 import time
 import bpy
+import bpy_extras.object_utils
 import mathutils
 import random
 import operator
 import math
 import string
+import hashlib
+import gzip
+import base64
+import json
+import re
+import array
+import mmap
+import struct
+import traceback
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 from bpy.props import *    
 
@@ -50,15 +65,16 @@ WEBKIT_TPL = """
 <head>
 <title>%(title)s</title>
 <style>%(style)s</style>
-<link href=\"%(track_path)s.css\" rel=\"stylesheet\" type=\"text/css\"/>
-<link href=\"%(track_path)s.overrides.css\" rel=\"stylesheet\" type=\"text/css\"/>
-</head>
+%(links)s</head>
 <body>
-<div id=\"root\">%(scene)s</div>
+<div id=\"root\"%(root_attrs)s>%(scene)s</div>
 </body>
 </html>
 """
 
+LINK_TPL = """<link href=\"%(href)s\" rel=\"stylesheet\" type=\"text/css\"/>
+"""
+
 TRACKS_TPL = """
 /* Animation keyframes */
 %(content)s
@@ -97,6 +113,11 @@ def initSceneProperties(scn):
         description="Use world space transforms instead of relying on parent-child transforms. Buggy with anims.",
         default=False)
 
+    bpy.types.Scene.cssexportcomposecollapsed = BoolProperty(
+        name="Compose Collapsed Transforms",
+        description="When collapsing transforms, only sample animated objects and derive their children's tracks from them. Objects with constraints, drivers or NLA tracks are still sampled",
+        default=False)
+
     bpy.types.Scene.cssexportanimfps = IntProperty(
         name="Override FPS",
         description="Override FPS",
@@ -107,6 +128,102 @@ def initSceneProperties(scn):
     description="Global Scale",
     default=1.0)
 
+    bpy.types.Scene.cssexporthashnames = BoolProperty(
+        name="Hash Filenames",
+        description="Add a content hash to exported stylesheet filenames so they can be cached indefinitely",
+        default=False)
+
+    bpy.types.Scene.cssexportprecompress = BoolProperty(
+        name="Precompress Output",
+        description="Also write .gz copies of exported files (and .br copies if the brotli module is available)",
+        default=False)
+
+    bpy.types.Scene.cssexportinline = BoolProperty(
+        name="Inline Export",
+        description="Embed keyframes, overrides and small images in a single self-contained html file",
+        default=False)
+
+    bpy.types.Scene.cssexportinlineimagelimit = IntProperty(
+        name="Inline Image Limit",
+        description="Largest image size in bytes to embed as a data URI when inlining",
+        default=8192)
+
+    bpy.types.Scene.cssexportminify = BoolProperty(
+        name="Minify",
+        description="Use short generated ids and animation names, and strip whitespace from the output",
+        default=False)
+
+    bpy.types.Scene.cssexportminifymap = BoolProperty(
+        name="Write Name Map",
+        description="When minifying, also write a json file mapping short ids back to object names",
+        default=False)
+
+    bpy.types.Scene.cssexportbatchframes = IntProperty(
+        name="Frames Per Update",
+        description="Number of frames to bake between UI updates when exporting interactively",
+        default=10,
+        min=1)
+
+    bpy.types.Scene.cssexportbakecache = BoolProperty(
+        name="Cache Baked Tracks",
+        description="Store baked samples next to the .blend file so re-exports with different output settings skip baking",
+        default=False)
+
+    bpy.types.Scene.cssexportindividualtransforms = BoolProperty(
+        name="Individual Transforms",
+        description="Use separate translate, rotate and scale properties, only animating the ones which change. Unbaked 3D tracks rotating about several axes keep transform keyframes",
+        default=False)
+
+    bpy.types.Scene.cssexportquantize = BoolProperty(
+        name="Quantize Keyframes",
+        description="Snap baked values to a grid and drop keyframes identical to both neighbours",
+        default=False)
+
+    bpy.types.Scene.cssexportquantizeloc = FloatProperty(
+        name="Location Step",
+        description="Location grid size in pixels",
+        default=0.1,
+        min=0.0)
+
+    bpy.types.Scene.cssexportquantizerot = FloatProperty(
+        name="Rotation Step",
+        description="Rotation step in degrees",
+        default=0.1,
+        min=0.0)
+
+    bpy.types.Scene.cssexportquantizescl = FloatProperty(
+        name="Scale Step",
+        description="Scale step",
+        default=0.001,
+        min=0.0)
+
+    bpy.types.Scene.cssexportquantizeerror = FloatProperty(
+        name="Max Error",
+        description="Largest on-screen error in pixels, steps are reduced for big elements to stay within it (0 to disable)",
+        default=0.5,
+        min=0.0)
+
+    bpy.types.Scene.cssexportcullfrustum = BoolProperty(
+        name="Cull Offscreen",
+        description="When exporting 3D, hide elements while they are outside the scene camera's view. The page's fixed perspective doesn't follow the camera, so elements near the edges may pop. Elements animated over a different range than the scene aren't culled",
+        default=False)
+
+    bpy.types.Scene.cssexportcolorstrategy = EnumProperty(
+        name="Color Animation",
+        description="How animated material colors are exported",
+        items=[('OVERLAY', "Overlay", "Fade the opacity of a tint layer, which the compositor can animate"),
+               ('BACKGROUND', "Background Color", "Animate background-color directly, which repaints every frame"),
+               ('NONE', "None", "Only export animated alpha")],
+        default='OVERLAY')
+
+    bpy.types.Scene.cssexportclips = EnumProperty(
+        name="Clips",
+        description="Export several clips sharing one layout stylesheet, switched by a class on the root element",
+        items=[('NONE', "Single", "Export the current scene's animation"),
+               ('SCENES', "Scenes", "Export each scene as a clip, laid out using the current scene"),
+               ('ACTIONS', "NLA Tracks", "Export each NLA track name as a clip, playing the tracks' actions on the current scene")],
+        default='NONE')
+
 initSceneProperties(bpy.context.scene)
 
 bpy.context.scene.cssexportcollapsetransforms = False
@@ -121,6 +238,14 @@ InterpolationLookup = {
     'BEZIER': 'bezier'
 }
 
+# Image formats browsers can show, for data URIs
+ImageMimeTypes = {
+    'PNG': 'image/png',
+    'JPEG': 'image/jpeg',
+    'BMP': 'image/bmp',
+    'WEBP': 'image/webp'
+}
+
 # Util
 
 import os.path
@@ -134,6 +259,41 @@ def basepath(filepath):
     # join drops last word (file name)
     return sep.join(words[:-1])
 
+# Gets short content hash for cache-busting filenames
+def contentHash(data):
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()[:10]
+
+# Gets short css identifier for an index, e.g. 0 -> a, 26 -> ba
+def shortName(index):
+    name = ""
+    while True:
+        name = string.ascii_lowercase[index % 26] + name
+        index //= 26
+        if index == 0:
+            return name
+
+# Trims redundant zeros from a css number, e.g. 0.500000 -> .5
+def trimNumber(match):
+    sign, whole, frac = match.groups()
+    whole = whole.lstrip('0')
+    frac = frac.rstrip('0')
+    if whole == "" and frac == "":
+        return "0"
+    if frac != "":
+        whole += "." + frac
+    return sign + whole
+
+# Strips whitespace, comments and redundant zeros from css, leaving url() alone
+def minifyCSS(data):
+    parts = re.split(r'(url\([^)]*\))', data)
+    for i in range(0, len(parts), 2):
+        part = re.sub(r'/\*.*?\*/', '', parts[i], flags=re.S)
+        part = re.sub(r'\s+', ' ', part)
+        part = re.sub(r' ?([{};:,]) ?', r'\1', part)
+        part = part.replace(';}', '}')
+        parts[i] = re.sub(r'(?<![\w.#-])(-?)(\d+)\.(\d+)', trimNumber, part)
+    return "".join(parts).strip()
+
 class Bitfield:
     INT_WIDTH=32
     
@@ -209,6 +369,10 @@ class SimpleTransform:
     MATTERS_SCL3D = MATTERS_SCLX | MATTERS_SCLY | MATTERS_SCLZ
 
     MATTERS_VIS=1<<9
+    MATTERS_COLOR=1<<10
+    
+    # Individual transform properties, in the order css applies them
+    CHANNELS = ['translate', 'rotate', 'scale']
     
     # Global scaling
     GLOBAL_SCALE = 10.0
@@ -219,6 +383,7 @@ class SimpleTransform:
         self.rot = [0,0,0]
         self.scl = [0,0,0]
         self.vis = True
+        self.color = None
         
         self.is3D = False
     
@@ -260,6 +425,10 @@ class SimpleTransform:
           self.matters |= SimpleTransform.MATTERS_VIS
         self.vis = vis
     
+    def setColor(self, r, g, b, a):
+        self.matters |= SimpleTransform.MATTERS_COLOR
+        self.color = [r, g, b, a]
+    
     def transformValue(self, threedee=False):
         string = ""
         list = []
@@ -304,20 +473,84 @@ class SimpleTransform:
                 list.append("scaleZ(%f)" % self.scl[2])
         
         return " ".join(list)
+    
+    # Values for the individual translate, rotate and scale properties.
+    # axis picks a single euler axis to rotate about in 3D.
+    def channelValues(self, threedee=False, axis=None):
+        values = {}
+        
+        if threedee:
+            values['translate'] = "%fpx %fpx %fpx" % (self.loc[0], self.loc[1], self.loc[2])
+        else:
+            values['translate'] = "%fpx %fpx" % (self.loc[0], self.loc[1])
+        
+        if threedee and axis != None:
+            values['rotate'] = "%s %frad" % ("xyz"[axis], -self.rot[axis])
+        elif threedee:
+            # rotate only takes a single axis, so compose rotateX() rotateY() rotateZ()
+            mat = mathutils.Matrix.Rotation(-self.rot[0], 3, 'X') @ \
+                  mathutils.Matrix.Rotation(-self.rot[1], 3, 'Y') @ \
+                  mathutils.Matrix.Rotation(-self.rot[2], 3, 'Z')
+            axis, angle = mat.to_quaternion().to_axis_angle()
+            values['rotate'] = "%f %f %f %frad" % (axis[0], axis[1], axis[2], angle)
+        else:
+            values['rotate'] = "%frad" % -self.rot[2]
+        
+        # Scale components which never got set are left out of transformValue
+        scl = [self.scl[0] if self.matters & SimpleTransform.MATTERS_SCLX else 1.0,
+               self.scl[1] if self.matters & SimpleTransform.MATTERS_SCLY else 1.0,
+               self.scl[2] if self.matters & SimpleTransform.MATTERS_SCLZ else 1.0]
+        if threedee:
+            values['scale'] = "%f %f %f" % (scl[0], scl[1], scl[2])
+        else:
+            values['scale'] = "%f %f" % (scl[0], scl[1])
+        
+        return values
 
 def scaleVA(arr, scale):
     return [x*scale for x in arr]
+
+def cssColor(color):
+    return "rgb(%d,%d,%d)" % (color[0] * 255, color[1] * 255, color[2] * 255)
+
+# Gets how far color lies along the line from first to far, for tint overlays
+def tintFactor(color, first, far):
+    delta = [far[i] - first[i] for i in range(0,3)]
+    t = sum([(color[i] - first[i]) * delta[i] for i in range(0,3)]) / sum([d*d for d in delta])
+    return min(max(t, 0.0), 1.0)
+
+def isIdentity(mat):
+    for i in range(0, 4):
+        for j in range(0, 4):
+            if abs(mat[i][j] - (1.0 if i == j else 0.0)) > 1e-6:
+                return False
+    return True
+
+def quantizeVA(arr, step):
+    if step <= 0.0:
+        return list(arr)
+    # + 0.0 avoids writing out -0
+    return [round(x / step) * step + 0.0 for x in arr]
     
 class SimpleObject:
-    def __init__(self, obj, scene, op):
+    def __init__(self, obj, scene, settings, op):
         self.name = obj.name.replace(".", "__")
         self.obj = obj
         self.parent = None
         self.children = []
         self.anim = None
+        self.animated = False
+        self.restLocal = obj.matrix_local.copy()
+        self.driven = self.isDriven()
+        self.cullFrames = [] # [frame, culled] for each change
+        self.cullIdentifier = self.name + '-cull'
+        self.cullStart = 0
+        self.cullLen = 0
+        self.cullable = True
         self.material = None
         self.transformOrigin = None
         self.scene = scene
+        self.settings = settings # scene whose export settings apply
         self.op = op
         
         if obj.type == 'MESH':
@@ -330,10 +563,21 @@ class SimpleObject:
             if len(mat_list) > 0:
                 self.material = mat_list[0].material
         
+    # Moved by something other than its own action, e.g. constraints or the NLA
+    def isDriven(self):
+        if len(self.obj.constraints) > 0:
+            return True
+        ipo = self.obj.animation_data
+        if ipo == None:
+            return False
+        return len(ipo.drivers) > 0 or (ipo.use_nla and len(ipo.nla_tracks) > 0)
+    
     def importIpo(self, ipo):
         anim = SimpleAnim(self, self.op)
         anim.grabAllFrameTimes(ipo)
+        anim.animates_transform = True
         self.anim = anim
+        self.animated = True
         return anim
     
     def blenderChildren(self):
@@ -342,10 +586,31 @@ class SimpleObject:
     def getTransform(self):
         mat = self.obj.matrix_local
         # Handle collapsed transforms
-        if self.scene.cssexportcollapsetransforms:
+        if self.settings.cssexportcollapsetransforms:
             mat = self.obj.matrix_world
             #mat = parentMat * mat
         
+        return self.matrixTransform(mat)
+    
+    # Gets world matrix from parents composed this frame, sampling only animated objects
+    def getComposedMatrix(self, composed):
+        if self in composed:
+            return composed[self]
+        
+        if self.driven:
+            # Only the evaluated scene knows where these are
+            mat = self.obj.matrix_world
+        else:
+            mat = self.restLocal
+            if self.animated:
+                mat = self.obj.matrix_local
+            if self.parent != None:
+                mat = self.parent.getComposedMatrix(composed) @ mat
+        
+        composed[self] = mat
+        return mat
+    
+    def matrixTransform(self, mat):
         loc = scaleVA(mat.to_translation(), SimpleTransform.GLOBAL_SCALE)
         rot = mat.to_euler()
         scl = mat.to_scale()
@@ -355,7 +620,7 @@ class SimpleObject:
         #self.op.report({'INFO'}, "[%i] %s getLocation: %f %f %f" % (bpy.context.scene.frame_current, self.obj.name, loc[0], -loc[1], loc[2]))
         #self.op.report({'INFO'}, "[%i] %s getRotation: %f %f %f" % (bpy.context.scene.frame_current, self.obj.name, rot[0], rot[1], rot[2]))
 
-        if self.scene.cssexportswitchaxis:
+        if self.settings.cssexportswitchaxis:
             trans.setLocation(loc[0], -loc[2], loc[1])
             trans.setRotation(rot[0], rot[2], rot[1])
             trans.setScale(scl[0], scl[2], scl[1])
@@ -412,6 +677,55 @@ class SimpleObject:
         box = obj.bound_box
         return scaleVA(min(box), SimpleTransform.GLOBAL_SCALE), scaleVA(max(box), SimpleTransform.GLOBAL_SCALE)
     
+    # Gets furthest distance from the origin covered by this element and its children
+    def getExtent(self):
+        extent = 0.0
+        if self.mesh != None:
+            minb, maxb = self.getBounds()
+            extent = math.sqrt(sum([max(abs(minb[i]), abs(maxb[i]))**2 for i in range(0,3)]))
+        
+        # Children only move with us when nested
+        if not self.settings.cssexportcollapsetransforms:
+            for child in self.children:
+                loc = child.getTransform().loc
+                extent = max(extent, math.sqrt(sum([v*v for v in loc])) + child.getExtent())
+        
+        return extent
+    
+    def getMaterialColor(self):
+        return list(self.material.diffuse_color)
+    
+    # Tests world bounds against the camera frustum
+    def isOffscreen(self, scene):
+        camera = scene.camera
+        mat = self.obj.matrix_world
+        coords = [bpy_extras.object_utils.world_to_camera_view(scene, camera, mat @ mathutils.Vector(corner))
+                  for corner in self.obj.bound_box]
+        
+        # Everything behind the camera, or past the far plane
+        if all([co[2] < camera.data.clip_start for co in coords]):
+            return True
+        if all([co[2] > camera.data.clip_end for co in coords]):
+            return True
+        
+        # Points behind the camera project mirrored, so only trust x,y when all are in front
+        if any([co[2] <= 0.0 for co in coords]):
+            return False
+        for axis in range(0, 2):
+            if all([co[axis] < 0.0 for co in coords]) or all([co[axis] > 1.0 for co in coords]):
+                return True
+        return False
+    
+    def setCulled(self, fid, culled):
+        if len(self.cullFrames) == 0 or self.cullFrames[-1][1] != culled:
+            self.cullFrames.append([fid, culled])
+    
+    def hasCullTrack(self):
+        for frame in self.cullFrames:
+            if frame[1]:
+                return True
+        return False
+    
     def getWorldCenter(self):
         if self.parent != None:
             center = self.parent.getWorldCenter()
@@ -426,6 +740,7 @@ class SimpleAnim:
     def __init__(self, obj, op):
         self.object = obj
         self.identifier = obj.name + '-anim'
+        self.tintIdentifier = self.identifier + '-tint'
         self.matters = None
         self.interpolation = None
         self.animates_layer = False
@@ -435,6 +750,100 @@ class SimpleAnim:
         self.len = 0
         self.op = op
         self.animates_vis = False
+        self.animates_color = False
+        self.animates_transform = False
+    
+    # Interpolation to record for baked frames
+    def frameInterpolation(self, doBake):
+        if doBake:
+            return "linear"
+        try:
+            return self.propertyInterpolation["TRANSFORM"]
+        except:
+            return "linear"
+    
+    # Snaps frame values to steps, keeping the on-screen error within maxError
+    # extent is the largest of the elements playing this anim
+    def quantize(self, locStep, rotStep, sclStep, maxError, extent, threedee):
+        if maxError > 0.0:
+            maxScale = 1.0
+            for frame in self.frames:
+                maxScale = max([maxScale] + [abs(v) for v in frame[1].scl])
+            
+            # Rounding moves values by up to half a step, which moves 
+            # the furthest point by the step times its lever arm.
+            # Errors from each channel and axis add up, so each gets its share.
+            channelError = maxError / 3.0
+            axes = 3 if threedee else 2
+            rotAxes = 3 if threedee else 1
+            locStep = min(locStep, channelError * 2.0 / axes)
+            if extent > 0.0:
+                rotStep = min(rotStep, channelError * 2.0 / (extent * maxScale * rotAxes))
+                sclStep = min(sclStep, channelError * 2.0 / (extent * axes))
+        
+        for frame in self.frames:
+            trans = frame[1]
+            trans.loc = quantizeVA(trans.loc, locStep)
+            trans.rot = quantizeVA(trans.rot, rotStep)
+            trans.scl = quantizeVA(trans.scl, sclStep)
+    
+    # Drops frames with the same values as both neighbours
+    def collapseFrames(self):
+        keys = [(tuple(frame[1].loc), tuple(frame[1].rot), tuple(frame[1].scl), frame[1].vis, 
+                 frame[1].color and tuple(frame[1].color)) for frame in self.frames]
+        frames = []
+        for i in range(0, len(self.frames)):
+            if i > 0 and i < len(self.frames)-1 and keys[i-1] == keys[i] and keys[i] == keys[i+1]:
+                continue
+            frames.append(self.frames[i])
+        self.frames = frames
+    
+    def animatesOpacity(self):
+        alphas = set([frame[1].color[3] for frame in self.frames if frame[1].color != None])
+        return len(alphas) > 1
+    
+    # First color and the one furthest from it, or None if the color is constant
+    def colorRange(self):
+        colors = [frame[1].color for frame in self.frames if frame[1].color != None]
+        if len(colors) == 0:
+            return None
+        
+        first = colors[0]
+        distances = [sum([(color[i] - first[i])**2 for i in range(0,3)]) for color in colors]
+        furthest = max(distances)
+        # Less than half a step in 8-bit color
+        if furthest < (0.5 / 255)**2:
+            return None
+        return first, colors[distances.index(furthest)]
+    
+    # Euler axis the track only ever rotates about, or None if it uses several
+    def rotationAxis(self):
+        axes = set([i for frame in self.frames for i in range(0, 3) if frame[1].rot[i] != 0.0])
+        if len(axes) > 1:
+            return None
+        if len(axes) == 1:
+            return axes.pop()
+        return 2
+    
+    # Whether individual properties tween the track like transform keyframes.
+    # A rotate about one fixed axis does, others get slerped, which only
+    # holds up between closely spaced baked frames.
+    def channelsMatchTransform(self, threedee, doBake):
+        return not threedee or doBake or self.rotationAxis() != None
+    
+    # Individual transform properties which change over the track
+    def varyingChannels(self, threedee, axis=None):
+        first = None
+        varying = set()
+        for frame in self.frames:
+            values = frame[1].channelValues(threedee, axis)
+            if first == None:
+                first = values
+                continue
+            for channel in SimpleTransform.CHANNELS:
+                if values[channel] != first[channel]:
+                    varying.add(channel)
+        return [channel for channel in SimpleTransform.CHANNELS if channel in varying]
     
     def encompassesFrame(self, fid):
         if fid >= self.start and fid < self.start+self.len:
@@ -537,6 +946,148 @@ class SimpleAnim:
             
         return earliest, latest
 
+# Persistent store of baked anim samples.
+# Layout is a small json index followed by packed doubles, which are 
+# memory-mapped on load so only the tracks actually used get read.
+class BakeCache:
+    MAGIC = b'CSSB'
+    VERSION = 3
+    HEADER = '<4sII'
+    
+    # fid, loc[3], rot[3], scl[3], matters, vis, color[4]
+    SAMPLE_SIZE = 16
+    
+    def __init__(self, path):
+        self.path = path
+        self.index = {}
+        self.entries = {}
+        self.map = None
+        self.data = None
+    
+    def load(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return
+        
+        fs = open(self.path, "rb")
+        try:
+            self.map = mmap.mmap(fs.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fs.close()
+        
+        # A damaged cache just means baking again
+        try:
+            self.parse()
+        except (struct.error, ValueError, TypeError, AttributeError):
+            self.close()
+            self.index = {}
+    
+    def parse(self):
+        headerSize = struct.calcsize(BakeCache.HEADER)
+        magic, version, indexSize = struct.unpack_from(BakeCache.HEADER, self.map, 0)
+        if magic != BakeCache.MAGIC or version != BakeCache.VERSION:
+            raise ValueError("not a bake cache")
+        
+        dataStart = (headerSize + indexSize + 7) & ~7
+        if dataStart > len(self.map) or (len(self.map) - dataStart) % 8 != 0:
+            raise ValueError("truncated bake cache")
+        index = json.loads(self.map[headerSize:headerSize+indexSize].decode('utf-8'))
+        self.data = memoryview(self.map)[dataStart:].cast('d')
+        
+        for offset, count in index.values():
+            if not isinstance(offset, int) or not isinstance(count, int):
+                raise ValueError("bad bake cache index")
+            if offset < 0 or count < 0 or offset + count*BakeCache.SAMPLE_SIZE > len(self.data):
+                raise ValueError("bake cache index out of range")
+        self.index = index
+    
+    def close(self):
+        if self.data != None:
+            self.data.release()
+            self.data = None
+        if self.map != None:
+            self.map.close()
+            self.map = None
+    
+    # Gets frames for key, or None if not cached
+    def get(self, key, interpolation):
+        if self.data == None or not key in self.index:
+            return None
+        
+        offset, count = self.index[key]
+        frames = []
+        for i in range(offset, offset + count*BakeCache.SAMPLE_SIZE, BakeCache.SAMPLE_SIZE):
+            trans = SimpleTransform()
+            trans.loc = list(self.data[i+1:i+4])
+            trans.rot = list(self.data[i+4:i+7])
+            trans.scl = list(self.data[i+7:i+10])
+            trans.matters = int(self.data[i+10])
+            trans.vis = self.data[i+11] != 0.0
+            if trans.matters & SimpleTransform.MATTERS_COLOR:
+                trans.color = list(self.data[i+12:i+16])
+            frames.append([int(self.data[i]), trans, interpolation])
+        return frames
+    
+    def put(self, key, frames):
+        values = array.array('d')
+        for frame in frames:
+            trans = frame[1]
+            values.append(frame[0])
+            values.extend(trans.loc)
+            values.extend(trans.rot)
+            values.extend(trans.scl)
+            values.append(trans.matters)
+            values.append(1.0 if trans.vis else 0.0)
+            values.extend(trans.color if trans.color != None else [0.0, 0.0, 0.0, 0.0])
+        self.entries[key] = values
+    
+    # Writes out everything put since loading, dropping stale tracks
+    def save(self):
+        self.close()
+        
+        index = {}
+        payload = array.array('d')
+        for key, values in self.entries.items():
+            index[key] = [len(payload), len(values) // BakeCache.SAMPLE_SIZE]
+            payload.extend(values)
+        
+        indexData = json.dumps(index).encode('utf-8')
+        header = struct.pack(BakeCache.HEADER, BakeCache.MAGIC, BakeCache.VERSION, len(indexData))
+        padding = b'\0' * (-(len(header) + len(indexData)) % 8)
+        
+        tmpPath = self.path + ".tmp"
+        fs = open(tmpPath, "wb")
+        try:
+            fs.write(header)
+            fs.write(indexData)
+            fs.write(padding)
+            fs.write(payload.tobytes())
+        finally:
+            fs.close()
+        os.replace(tmpPath, self.path)
+
+# A scene, or set of actions, exported as one keyframes stylesheet
+class SimpleClip:
+    def __init__(self, name, scene, cacheName, actions=None):
+        self.name = name
+        self.scene = scene
+        self.cacheName = cacheName
+        self.actions = actions # object name -> action, None leaves actions alone
+        self.savedActions = []
+        self.index = 0
+        self.objects = []
+        self.anims = []
+        self.pendingAnims = []
+        self.bakeFrames = []
+        self.bakeIndex = 0
+        self.bakeCache = None
+        self.restoreFrame = scene.frame_current
+        self.viewLayer = None
+        self.cull = False
+    
+    # Class set on the root element to play this clip
+    def className(self):
+        return "clip-%s" % re.sub(r'[^\w-]', '_', self.name)
+
 def halfOf(p1, p2):
     x = (p2[0] - p1[0]) * 0.5
     y = (p2[1] - p1[1]) * 0.5
@@ -563,6 +1114,9 @@ class ExportCSSData(bpy.types.Operator):
             default="*.html",
             options={'HIDDEN'},
             )
+    
+    # Set by invoke, scripted exports never open the file browser
+    _interactive = False
 
     @classmethod
     def poll(cls, context):
@@ -576,23 +1130,79 @@ class ExportCSSData(bpy.types.Operator):
         if not self.filepath.endswith('.html'):
             self.filepath += '.html'
 
-        self.doExport(self.filepath, context)
+        # Scripts expect the file to exist once the operator returns
+        if not self._interactive:
+            self.doExport(self.filepath, context)
+            return {'FINISHED'}
+        
+        # Bake in batches from a timer so the UI stays responsive
+        try:
+            self.beginExport(context)
+        except Exception as err:
+            self.cancelExport()
+            return self.exportFailed(err)
+        wm = context.window_manager
+        self._timer = wm.event_timer_add(0.01, window=context.window)
+        wm.modal_handler_add(self)
+        wm.progress_begin(0, len(self.clips))
+        
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            # Nothing has been written yet, so just stop
+            self.endModal(context)
+            self.cancelExport()
+            self.report({'WARNING'}, "Export cancelled")
+            return {'CANCELLED'}
         
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+        
+        try:
+            if self.bakeBatch(self.settings.cssexportbatchframes):
+                clip = self.clips[self.clipIndex]
+                progress = self.clipIndex + float(clip.bakeIndex) / max(len(clip.bakeFrames), 1)
+                context.window_manager.progress_update(progress)
+                return {'RUNNING_MODAL'}
+            
+            self.finishExport(self.filepath, context)
+        except Exception as err:
+            self.endModal(context)
+            self.cancelExport()
+            return self.exportFailed(err)
+        
+        self.endModal(context)
         return {'FINISHED'}
+    
+    def exportFailed(self, err):
+        traceback.print_exc()
+        self.report({'ERROR'}, "Export failed: %s" % err)
+        return {'CANCELLED'}
+
+    def endModal(self, context):
+        wm = context.window_manager
+        wm.event_timer_remove(self._timer)
+        wm.progress_end()
         
     def invoke(self, context, event):
+        self._interactive = True
         context.window_manager.fileselect_add(self)
         return {'RUNNING_MODAL'}
 
     # Recursively makes sure child elements have anim tracks (for collapsed transforms)
     def recursiveAnimClone(self, obj, new_anims):
         parent = obj.parent
-        if parent != None and parent.anim != None:
+        # Color changes don't carry over to children
+        if parent != None and parent.anim != None and parent.anim.animates_transform:
             if obj.anim == None:
                 obj.anim = SimpleAnim(obj, self)
                 obj.anim.matters = Bitfield(parent.anim.matters.size)
+                obj.anim.start = parent.anim.start
+                obj.anim.len = parent.anim.len
                 new_anims.append(obj.anim)
             obj.anim.combineFrom(parent.anim)
+            obj.anim.animates_transform = True
         
         for child in obj.children:
             self.recursiveAnimClone(child, new_anims)
@@ -608,12 +1218,25 @@ class ExportCSSData(bpy.types.Operator):
                 continue
             
             ipo = obj.animation_data
-            built_object = SimpleObject(obj, scene, self)
+            built_object = SimpleObject(obj, scene, self.settings, self)
             
             if ipo != None and ipo.action != None and len(ipo.action.fcurves) != 0:
                 self.report({'INFO'}, "Importing curve for %s" % obj.name)
                 anims_list.append(built_object.importIpo(ipo.action))
             
+            # Material animation goes in the same track
+            mat = built_object.material
+            if mat != None and mat.animation_data != None and mat.animation_data.action != None and len(mat.animation_data.action.fcurves) != 0:
+                self.report({'INFO'}, "Importing material curve for %s" % obj.name)
+                mat_anim = SimpleAnim(built_object, self)
+                mat_anim.grabAllFrameTimes(mat.animation_data.action)
+                if built_object.anim == None:
+                    built_object.anim = mat_anim
+                    anims_list.append(mat_anim)
+                else:
+                    built_object.anim.combineFrom(mat_anim)
+                built_object.anim.animates_color = True
+            
             # Insert into correct list
             if parent != None:
                 built_object.parent = parent
@@ -625,56 +1248,365 @@ class ExportCSSData(bpy.types.Operator):
             self.importObjects(built_object.blenderChildren(), out_list, anims_list, scene, built_object)
 
 
+    # Recursively assigns short names to objects, reusing any in names
+    def internNames(self, olist, names):
+        for obj in olist:
+            if not obj.obj.name in names:
+                index = len(names)
+                # Don't clash with the container
+                while shortName(index) == "root" or shortName(index) in names.values():
+                    index += 1
+                names[obj.obj.name] = shortName(index)
+            obj.name = names[obj.obj.name]
+            self.internNames(obj.children, names)
+
+    # Recursively builds map of exported names to blender names
+    def nameMap(self, olist, out_map):
+        for obj in olist:
+            out_map[obj.name] = obj.obj.name
+            self.nameMap(obj.children, out_map)
+        return out_map
+
     def doExport(self, filePath, context):
+        try:
+            self.beginExport(context)
+            while self.bakeBatch(self.settings.cssexportbatchframes):
+                pass
+        except:
+            # Put the scene's actions and frame back before giving up
+            self.cancelExport()
+            raise
+        self.finishExport(filePath, context)
+    
+    # Points static children sitting on an animated parent's origin at the 
+    # parent's anim, as their composed world tracks would be identical
+    def shareComposedAnims(self, olist, anims):
+        for obj in olist:
+            parent = obj.parent
+            if (parent != None and parent.anim != None and not obj.animated and
+                not obj.driven and isIdentity(obj.restLocal) and not parent.anim.animates_vis and
+                not parent.anim.animates_color and not obj.anim.animates_color and
+                obj.obj.hide_render == parent.obj.hide_render and
+                obj.anim.start == parent.anim.start and obj.anim.len == parent.anim.len):
+                anims.remove(obj.anim)
+                obj.anim = parent.anim
+            self.shareComposedAnims(obj.children, anims)
+    
+    # Gathers the clips to export
+    def collectClips(self, scene):
+        if scene.cssexportclips == 'SCENES':
+            scenes = [scene] + [other for other in bpy.data.scenes if other != scene]
+            clips = [SimpleClip(other.name, other, other.name) for other in scenes]
+        elif scene.cssexportclips == 'ACTIONS':
+            # Tracks with the same name on different objects make up one clip
+            clips = []
+            tracks = {}
+            for obj in scene.objects:
+                ipo = obj.animation_data
+                if ipo == None:
+                    continue
+                for track in ipo.nla_tracks:
+                    if len(track.strips) == 0 or track.strips[0].action == None:
+                        continue
+                    if not track.name in tracks:
+                        tracks[track.name] = {}
+                        clips.append(SimpleClip(track.name, scene, "%s-%s" % (scene.name, track.name), tracks[track.name]))
+                    tracks[track.name][obj.name] = track.strips[0].action
+            
+            if len(clips) == 0:
+                self.report({'WARNING'}, "No NLA tracks found, exporting current actions")
+                clips = [SimpleClip(scene.name, scene, scene.name)]
+        else:
+            clips = [SimpleClip(scene.name, scene, scene.name)]
+        
+        for i in range(0, len(clips)):
+            clips[i].index = i
+        return clips
+    
+    # Plays the clip's actions on their objects, without the NLA on top
+    def applyClip(self, clip):
+        if clip.actions == None:
+            return
+        
+        clip.savedActions = []
+        for obj in clip.scene.objects:
+            ipo = obj.animation_data
+            if ipo == None:
+                continue
+            clip.savedActions.append([ipo, ipo.action, ipo.use_nla])
+            ipo.action = clip.actions.get(obj.name)
+            ipo.use_nla = False
+    
+    # Safe to call more than once, or after a partial applyClip
+    def restoreClip(self, clip):
+        saved = clip.savedActions
+        clip.savedActions = []
+        for ipo, action, use_nla in saved:
+            try:
+                ipo.action = action
+                ipo.use_nla = use_nla
+            except ReferenceError:
+                # The object went away while exporting
+                pass
+    
+    def beginExport(self, context):
         scene = context.scene
         
-        ctx = scene.render
+        SimpleTransform.GLOBAL_SCALE = scene.cssexportglobalscale
+        
+        self.settings = scene
+        self.clips = []
+        self.clipIndex = 0
+        self.clips = self.collectClips(scene)
+        self.shortNames = {}
+        self.beginClip(self.clips[0])
+    
+    # Imports objects and prepares anims for baking
+    def beginClip(self, clip):
+        scene = clip.scene
+        settings = self.settings
         
         objects = []
         anims = []
-
-        SimpleTransform.GLOBAL_SCALE = scene.cssexportglobalscale
         
+        self.applyClip(clip)
+        clip.restoreFrame = scene.frame_current
         scene.frame_set(1)
         
+        if scene == bpy.context.scene:
+            clip.viewLayer = bpy.context.view_layer
+        else:
+            clip.viewLayer = scene.view_layers[0]
+        
         # Import objects and frame times
         self.importObjects(scene.objects, objects, anims, scene)
         
         # Collapse transforms if neccesary
-        if scene.cssexportcollapsetransforms:
+        if settings.cssexportcollapsetransforms:
             new_anims = []
             for anim in anims:
                 self.recursiveAnimClone(anim.object, new_anims)
             anims += new_anims
         
-        # Clear anim frames
+        # Swap names for short ones, consistently across clips
+        if settings.cssexportminify:
+            self.internNames(objects, self.shortNames)
+            for anim in anims:
+                anim.identifier = anim.object.name
+        
+        for anim in anims:
+            if settings.cssexportminify:
+                anim.tintIdentifier = anim.identifier + '-t'
+            else:
+                anim.tintIdentifier = anim.identifier + '-tint'
+            anim.identifier = self.clipIdentifier(anim.identifier, clip)
+            anim.tintIdentifier = self.clipIdentifier(anim.tintIdentifier, clip)
+        
+        if settings.cssexportcollapsetransforms and settings.cssexportcomposecollapsed:
+            self.shareComposedAnims(objects, anims)
+        
+        clip.cull = settings.cssexportcullfrustum and settings.cssexport3d and scene.camera != None
+        if clip.cull:
+            self.prepareCulling(objects, clip)
+        
+        doBake = settings.cssexportbakeanim
+        
+        clip.bakeCache = None
+        if settings.cssexportbakecache and bpy.data.filepath:
+            cachePath = "%s-%s.csscache" % (os.path.splitext(bpy.data.filepath)[0], clip.cacheName)
+            clip.bakeCache = BakeCache(cachePath)
+            clip.bakeCache.load()
+        
+        # Clear anim frames, filling in any we already baked
+        pending = []
         for anim in anims:
             anim.frames = []
+            if clip.bakeCache != None:
+                anim.bakeKey = self.bakeKey(anim, scene, settings)
+                frames = clip.bakeCache.get(anim.bakeKey, anim.frameInterpolation(doBake))
+                if frames != None:
+                    anim.frames = frames
+                    continue
+            pending.append(anim)
         
-        doBake = scene.cssexportbakeanim
+        clip.objects = objects
+        clip.anims = anims
+        clip.pendingAnims = pending
+        clip.bakeFrames = [fid for fid in range(scene.frame_start, scene.frame_end+1)
+                           if clip.cull or self.frameNeeded(fid, pending, doBake)]
+        clip.bakeIndex = 0
+    
+    # Keyframes from every clip can be loaded at once, so names get the clip 
+    # added after any -t/-c suffix to keep them apart
+    def clipIdentifier(self, identifier, clip):
+        if self.settings.cssexportclips == 'NONE':
+            return identifier
+        if self.settings.cssexportminify:
+            return "%s-%s" % (identifier, shortName(clip.index))
+        return "%s-%s" % (clip.className(), identifier)
+    
+    # Names cull tracks, which cover the whole scene
+    def prepareCulling(self, olist, clip):
+        settings = self.settings
+        for obj in olist:
+            if settings.cssexportminify:
+                obj.cullIdentifier = obj.name + '-c'
+            else:
+                obj.cullIdentifier = obj.name + '-cull'
+            obj.cullIdentifier = self.clipIdentifier(obj.cullIdentifier, clip)
+            
+            obj.cullStart = clip.scene.frame_start
+            obj.cullLen = clip.scene.frame_end + 1 - clip.scene.frame_start # inclusive, like anims
+            
+            # Tracks over other ranges would play out of step with the cull track
+            anim = obj.anim
+            obj.cullable = anim == None or (anim.start == obj.cullStart and anim.len == obj.cullLen)
+            self.prepareCulling(obj.children, clip)
+    
+    # Records which objects are offscreen this frame, returns True if all of olist is.
+    # Nested elements only get hidden when all their children are offscreen too.
+    def cullObjects(self, olist, scene, fid):
+        allCulled = True
+        for obj in olist:
+            childrenCulled = self.cullObjects(obj.children, scene, fid)
+            
+            # Culling would fight any visibility animation
+            culled = False
+            if obj.cullable and not obj.obj.hide_render and (obj.anim == None or not obj.anim.animates_vis):
+                culled = obj.isOffscreen(scene)
+            if not self.settings.cssexportcollapsetransforms:
+                culled = culled and childrenCulled
+            
+            obj.setCulled(fid, culled)
+            allCulled = allCulled and culled
+        return allCulled
+    
+    def endClip(self, clip):
+        if clip.bakeCache != None:
+            for anim in clip.anims:
+                clip.bakeCache.put(anim.bakeKey, anim.frames)
+            clip.bakeCache.save()
         
-        # Grab frames for all anims
-        for fid in range(scene.frame_start, scene.frame_end):
+        clip.scene.frame_set(clip.restoreFrame)
+        self.restoreClip(clip)
+    
+    def cancelExport(self):
+        # Every clip was already ended and restored
+        if self.clipIndex >= len(self.clips):
+            return
+        
+        clip = self.clips[self.clipIndex]
+        if clip.bakeCache != None:
+            clip.bakeCache.close()
+        clip.scene.frame_set(clip.restoreFrame)
+        self.restoreClip(clip)
+    
+    def frameNeeded(self, fid, anims, doBake):
+        for anim in anims:
+            if anim.matters[fid] or (doBake and anim.encompassesFrame(fid)):
+                return True
+        return False
+    
+    # Identifies the inputs to an anim's baked samples.
+    # NOTE: drivers and constraints referencing other objects aren't tracked.
+    def bakeKey(self, anim, scene, settings):
+        key = hashlib.sha1()
+        key.update(repr((scene.frame_start, scene.frame_end, settings.cssexportbakeanim,
+                         settings.cssexportcollapsetransforms, settings.cssexportcomposecollapsed,
+                         settings.cssexportswitchaxis, settings.cssexportglobalscale,
+                         anim.start, anim.len)).encode('utf-8'))
+        
+        obj = anim.object
+        while obj != None:
+            key.update(obj.obj.name.encode('utf-8'))
+            key.update(repr([tuple(row) for row in obj.obj.matrix_local]).encode('utf-8'))
+            
+            actions = []
+            if obj.obj.animation_data != None and obj.obj.animation_data.action != None:
+                actions.append(obj.obj.animation_data.action)
+            if obj.material != None and obj.material.animation_data != None and obj.material.animation_data.action != None:
+                actions.append(obj.material.animation_data.action)
+            
+            for action in actions:
+                for fcurve in action.fcurves:
+                    key.update(repr((fcurve.data_path, fcurve.array_index, fcurve.extrapolation, len(fcurve.modifiers))).encode('utf-8'))
+                    for point in fcurve.keyframe_points:
+                        key.update(repr((tuple(point.co), tuple(point.handle_left), tuple(point.handle_right),
+                                         point.interpolation, point.easing)).encode('utf-8'))
+            
+            # World transforms depend on the whole parent chain
+            if not settings.cssexportcollapsetransforms:
+                break
+            obj = obj.parent
+        
+        return key.hexdigest()
+    
+    # Grabs frames for up to count scene frames, returns True if more remain
+    def bakeBatch(self, count):
+        clip = self.clips[self.clipIndex]
+        scene = clip.scene
+        settings = self.settings
+        doBake = settings.cssexportbakeanim
+        compose = settings.cssexportcollapsetransforms and settings.cssexportcomposecollapsed
+        
+        for fid in clip.bakeFrames[clip.bakeIndex:clip.bakeIndex+count]:
             scene.frame_set(fid)
-            bpy.context.view_layer.update()
+            clip.viewLayer.update()
             
-            for anim in anims:
+            if clip.cull:
+                self.cullObjects(clip.objects, scene, fid)
+            
+            composed = {}
+            for anim in clip.pendingAnims:
                 if anim.matters[fid] or (doBake and anim.encompassesFrame(fid)):
-                    # TODO: grab material color, etc
-                    interpolation = None
-                    try:
-                        interpolation = anim.propertyInterpolation["TRANSFORM"]
-                    except:
-                        interpolation = "linear"
-                    
-                    if doBake:
-                        interpolation = "linear"
-
-                    anim.frames.append([fid, anim.object.getTransform(), interpolation])
+                    if compose:
+                        obj = anim.object
+                        trans = obj.matrixTransform(obj.getComposedMatrix(composed))
+                        trans.setVis(not obj.obj.hide_render)
+                    else:
+                        trans = anim.object.getTransform()
+                    if anim.animates_color:
+                        trans.setColor(*anim.object.getMaterialColor())
+                    anim.frames.append([fid, trans, anim.frameInterpolation(doBake)])
+            
+            clip.bakeIndex += 1
+        
+        if clip.bakeIndex < len(clip.bakeFrames):
+            return True
+        
+        # Move on to the next clip
+        self.endClip(clip)
+        self.clipIndex += 1
+        if self.clipIndex < len(self.clips):
+            self.beginClip(self.clips[self.clipIndex])
+            return True
+        return False
+    
+    def finishExport(self, filePath, context):
+        # Quantize after caching so the cache keeps raw samples
+        scene = self.settings
+        if scene.cssexportquantize:
+            for clip in self.clips:
+                extents = self.animExtents(clip.objects, {})
+                for anim in clip.anims:
+                    anim.quantize(scene.cssexportquantizeloc, math.radians(scene.cssexportquantizerot),
+                                  scene.cssexportquantizescl, scene.cssexportquantizeerror,
+                                  extents.get(anim, 0.0), scene.cssexport3d)
+                    anim.collapseFrames()
         
-        self.exportCSS(objects, anims, scene, filePath)
+        self.exportCSS(self.clips, scene, filePath)
     
-    def exportCSS(self, objects, anims, scene, filename):
+    # Largest extent of the elements playing each anim, as composed anims are shared
+    def animExtents(self, olist, extents):
+        for obj in olist:
+            if obj.anim != None:
+                extents[obj.anim] = max(extents.get(obj.anim, 0.0), obj.getExtent())
+            self.animExtents(obj.children, extents)
+        return extents
+    
+    def exportCSS(self, clips, scene, filename):
+        clipMode = scene.cssexportclips != 'NONE'
+        
         # Second step: output webkit stuff
         doc = []
         style = ["#root div {position: absolute;}\n",
@@ -687,20 +1619,167 @@ class ExportCSSData(bpy.types.Operator):
             style.append("perspective-origin: center 240px;")
         style.append("}\n")
         
-        self.exportObjects(objects, doc, style, scene)
+        className = bpy.path.ensure_ext(bpy.path.basename(filename), '')
+        classPath = basepath(str(filename))
+        
+        # Layout comes from the first clip
+        objects = clips[0].objects
+        self.imageBackgrounds = {}
+        self.inlineImages = []
+        self.exportObjects(objects, doc, style, scene, classPath)
+        
+        # Inlined images are written once, for any element to use
+        if len(self.inlineImages) > 0:
+            style.append("#root {\n")
+            for var, url in self.inlineImages:
+                style.append("%s: url(\"%s\");\n" % (var, url))
+            style.append("}\n")
 
         self.report({'INFO'}, f"Exporting html to: {filename}")
         
-        className = bpy.path.ensure_ext(bpy.path.basename(filename), '')
-        classPath = basepath(str(filename))
-        animName = "%s-%s" % (className, scene.name) 
+        inline = scene.cssexportinline and not scene.cssexportanimtrackonly
+        
+        # Stylesheets to link, in order
+        sheets = []
+        for clip in clips:
+            tracks = []
+            if clipMode:
+                tracks += self.clipRules(clip, scene)
+            tracks += self.exportTracks(clip.anims, scene)
+            tracks += self.exportCullTracks(clip.objects, scene)
+            
+            css_substitutions = {'content': "".join(tracks)}
+            tracksData = TRACKS_TPL % css_substitutions
+            if scene.cssexportminify:
+                tracksData = minifyCSS(tracksData)
+            sheets.append(["%s-%s" % (className, clip.name), tracksData])
+        
+        if scene.cssexportminify:
+            style = [minifyCSS("".join(style))]
+            doc = ["".join(doc).replace("\n", "")]
+            
+            if scene.cssexportminifymap:
+                mapData = json.dumps(self.nameMap(objects, {}), indent=1, sort_keys=True)
+                self.writeFile("%s/%s.map.json" % (classPath, className), mapData.encode('utf-8'))
+        
+        # Layout is shared between clips, so goes in its own file
+        if clipMode and not inline:
+            sheets.insert(0, ["%s.base" % className, "".join(style)])
+            style = []
+        
+        if clipMode:
+            overridesName = "%s.overrides.css" % className
+        else:
+            overridesName = "%s.overrides.css" % sheets[0][0]
+        overridesPath = "%s/%s" % (classPath, overridesName)
+        overridesData = None
+        if os.path.exists(overridesPath):
+            fs = open(overridesPath, "r")
+            overridesData = fs.read()
+            fs.close()
+        
+        links = []
+        if inline:
+            # Everything goes in the style block, overrides last
+            for sheetName, sheetData in sheets:
+                style.append(sheetData)
+            if overridesData != None:
+                style.append(overridesData)
+        else:
+            # Dump tracks
+            for sheetName, sheetData in sheets:
+                trackName = "%s.css" % sheetName
+                if scene.cssexporthashnames:
+                    self.removeCompressed("%s/%s" % (classPath, trackName))
+                    trackName = "%s.%s.css" % (sheetName, contentHash(sheetData))
+                self.writeOutput("%s/%s" % (classPath, trackName), sheetData, scene)
+                links.append(LINK_TPL % {'href': trackName})
+            
+            # Overrides are hand-written, so they only get copied when hashing
+            if scene.cssexporthashnames and overridesData != None:
+                overridesName = "%s.%s.css" % (overridesName[:-4], contentHash(overridesData))
+                self.writeOutput("%s/%s" % (classPath, overridesName), overridesData, scene)
+            
+            links.append(LINK_TPL % {'href': overridesName})
+        
+        rootAttrs = ""
+        if clipMode:
+            rootAttrs = " class=\"%s\"" % clips[0].className()
+        
+        substitutions = {'title': className, 'style': "".join(style), 'links': "".join(links), 
+                         'root_attrs': rootAttrs, 'scene': "".join(doc)}
+        
+        # Dump to document
+        if not scene.cssexportanimtrackonly:
+            html = WEBKIT_TPL % substitutions
+            if scene.cssexportminify:
+                html = re.sub(r'>\s+<', '><', html).strip()
+            self.writeOutput("%s/%s.html" % (classPath, className), html, scene)
+
+    # Animation properties for elements playing a clip
+    def clipRules(self, clip, scene, olist=None, rules=None):
+        if olist == None:
+            olist = clip.objects
+            rules = []
+        
+        # Walk objects rather than anims, as anims can be shared
+        for obj in olist:
+            anim = obj.anim
+            if anim != None or obj.hasCullTrack():
+                rules.append("#root.%s #%s {\n" % (clip.className(), obj.name))
+                
+                # Static channels and colors may differ from the layout's
+                if anim != None and len(anim.frames) > 0:
+                    first = anim.frames[0][1]
+                    if not scene.cssexportindividualtransforms:
+                        if not anim.animates_transform:
+                            rules.append("transform: %s;\n" % first.transformValue(scene.cssexport3d))
+                    elif anim.channelsMatchTransform(scene.cssexport3d, scene.cssexportbakeanim):
+                        values = first.channelValues(scene.cssexport3d, self.rotationAxis(anim, scene))
+                        for channel in SimpleTransform.CHANNELS:
+                            rules.append("%s: %s;\n" % (channel, values[channel]))
+                        rules.append("transform: none;\n")
+                    else:
+                        for channel in SimpleTransform.CHANNELS:
+                            rules.append("%s: none;\n" % channel)
+                        rules.append("transform: %s;\n" % first.transformValue(scene.cssexport3d))
+                    if anim.animates_color:
+                        if obj.material.blend_method == 'OPAQUE':
+                            rules.append("background-color: %s;\n" % cssColor(first.color))
+                        rules.append("opacity: %f;\n" % first.color[3])
+                
+                rules += self.animationStyle(obj, scene)
+                rules.append("}\n")
+                rules += self.overlayStyle(obj, "#root.%s #%s" % (clip.className(), obj.name), scene)
+            self.clipRules(clip, scene, obj.children, rules)
+        return rules
+
+    # Single axis for the anim's rotate property, when it has one
+    def rotationAxis(self, anim, scene):
+        if not scene.cssexport3d:
+            return None
+        return anim.rotationAxis()
+
+    def exportTracks(self, anims, scene):
         doBake = scene.cssexportbakeanim
+        individual = scene.cssexportindividualtransforms
         
         tracks = []
         # Animation keyframes
         for anim in anims:
             tracks.append("@keyframes %s {\n" % anim.identifier)
             
+            # Static channels are already set on the element
+            channels = None
+            if individual and anim.channelsMatchTransform(scene.cssexport3d, doBake):
+                axis = self.rotationAxis(anim, scene)
+                channels = anim.varyingChannels(scene.cssexport3d, axis)
+            
+            fades = anim.animatesOpacity()
+            backgroundColors = None
+            if scene.cssexportcolorstrategy == 'BACKGROUND':
+                backgroundColors = self.animatedColorRange(anim.object, scene)
+            
             earliest = anim.start
             fl = anim.len-1
             frames = anim.frames
@@ -711,40 +1790,224 @@ class ExportCSSData(bpy.types.Operator):
                 percent = float(frame[0] - earliest) / fl
                 fid = ("%2.2f" % (percent*100)) + "%"
                 
-                tracks.append("%s {\n" % fid)
-                tracks.append("transform: %s;\n" % frame[1].transformValue(scene.cssexport3d))
+                props = []
+                if anim.animates_transform:
+                    if channels != None:
+                        values = frame[1].channelValues(scene.cssexport3d, axis)
+                        for channel in channels:
+                            props.append("%s: %s;\n" % (channel, values[channel]))
+                    else:
+                        props.append("transform: %s;\n" % frame[1].transformValue(scene.cssexport3d))
                 if anim.animates_vis:
                     if not frame[1].vis:
-                        tracks.append("visibility: hidden;\n")
+                        props.append("visibility: hidden;\n")
                     else:
-                        tracks.append("visibility: visible;\n")    
+                        props.append("visibility: visible;\n")    
+                if fades:
+                    props.append("opacity: %f;\n" % frame[1].color[3])
+                if backgroundColors != None:
+                    props.append("background-color: %s;\n" % cssColor(frame[1].color))
+                if len(props) == 0:
+                    continue
                 if not doBake:
-                    tracks.append("animation-timing-function: %s;\n" % InterpolationLookup[frame[2]])
+                    props.append("animation-timing-function: %s;\n" % InterpolationLookup[frame[2]])
+                
+                tracks.append("%s {\n" % fid)
+                tracks += props
                 tracks.append("}\n")
             
             tracks.append("}\n")
+            
+            # Overlay opacity standing in for color changes
+            tintColors = None
+            if scene.cssexportcolorstrategy == 'OVERLAY':
+                tintColors = self.animatedColorRange(anim.object, scene)
+            if tintColors != None:
+                tracks.append("@keyframes %s {\n" % anim.tintIdentifier)
+                for frame in frames:
+                    percent = float(frame[0] - earliest) / fl
+                    tracks.append("%s {\n" % (("%2.2f" % (percent*100)) + "%"))
+                    tracks.append("opacity: %f;\n" % tintFactor(frame[1].color, tintColors[0], tintColors[1]))
+                    if not doBake:
+                        tracks.append("animation-timing-function: %s;\n" % InterpolationLookup[frame[2]])
+                    tracks.append("}\n")
+                tracks.append("}\n")
+        return tracks
+
+    # Range of animated material color, if it should be exported
+    def animatedColorRange(self, obj, scene):
+        if obj.anim == None or not obj.anim.animates_color or obj.material.blend_method != 'OPAQUE':
+            return None
+        if scene.cssexportcolorstrategy == 'NONE':
+            return None
+        return obj.anim.colorRange()
+
+    # Tint layer over the element, faded in towards the furthest color
+    def overlayStyle(self, obj, selector, scene):
+        if scene.cssexportcolorstrategy != 'OVERLAY':
+            return []
+        colors = self.animatedColorRange(obj, scene)
+        if colors == None:
+            return []
         
-        substitutions = {'title': className, 'style': "".join(style), 'track_path':animName, 'scene': "".join(doc)}
-        css_substitutions = {'content': "".join(tracks)}
+        anim = obj.anim
+        style = []
+        style.append("%s::before {\n" % selector)
+        style.append("content: \"\";\n")
+        style.append("position: absolute;\n")
+        style.append("left: 0px;\n")
+        style.append("top: 0px;\n")
+        style.append("width: 100%;\n")
+        style.append("height: 100%;\n")
+        style.append("background-color: %s;\n" % cssColor(colors[1]))
+        style.append("opacity: %f;\n" % tintFactor(anim.frames[0][1].color, colors[0], colors[1]))
         
-        # Dump tracks
-        fs = open("%s/%s.css" % (classPath, animName), "w")
-        fs.write(TRACKS_TPL % css_substitutions)
-        fs.close()
+        style += self.animationStyle(obj, scene, True)
+        style.append("}\n")
+        return style
+
+    # Visibility toggles for culled elements
+    def exportCullTracks(self, olist, scene, tracks=None):
+        if tracks == None:
+            tracks = []
         
-        # Dump to document
-        if not scene.cssexportanimtrackonly:
-            fs = open("%s/%s.html" % (classPath, className), "w")
-            fs.write(WEBKIT_TPL % substitutions)
-            fs.close()
+        for obj in olist:
+            if obj.hasCullTrack():
+                tracks.append("@keyframes %s {\n" % obj.cullIdentifier)
+                fl = obj.cullLen-1
+                for frame in obj.cullFrames:
+                    percent = float(frame[0] - obj.cullStart) / fl
+                    tracks.append("%s {\n" % (("%2.2f" % (percent*100)) + "%"))
+                    if frame[1]:
+                        tracks.append("visibility: hidden;\n")
+                    else:
+                        tracks.append("visibility: visible;\n")
+                    tracks.append("}\n")
+                tracks.append("}\n")
+            self.exportCullTracks(obj.children, scene, tracks)
+        return tracks
 
-    def exportObjects(self, olist, doc, style, scene):
-        threedee = scene.cssexport3d
+    # Animation properties for an element, or its tint layer
+    def animationStyle(self, obj, scene, tint=False):
         fps = None
         if scene.cssexportanimfps == 0.0:
             fps = scene.render.fps
         else:
             fps = scene.cssexportanimfps
+        
+        names = []
+        durations = []
+        delays = []
+        timings = []
+        
+        if obj.anim != None:
+            anim = obj.anim
+            if tint:
+                names.append(anim.tintIdentifier)
+            else:
+                names.append(anim.identifier)
+            durations.append("%fs" % (anim.len / fps))
+            delays.append("%fs" % ((anim.start-1) / fps))
+            timings.append("linear" if scene.cssexportbakeanim else "ease")
+        
+        # Culling holds each state until the next toggle
+        if not tint and obj.hasCullTrack():
+            names.append(obj.cullIdentifier)
+            durations.append("%fs" % (obj.cullLen / fps))
+            delays.append("%fs" % ((obj.cullStart-1) / fps))
+            timings.append("step-end")
+        
+        style = []
+        style.append("animation-name: %s;\n" % ", ".join(names))
+        style.append("animation-duration: %s;\n" % ", ".join(durations))
+        style.append("animation-delay: %s;\n" % ", ".join(delays))
+        
+        if scene.cssexportanimloop:
+            style.append("animation-iteration-count: infinite;\n")
+        if scene.cssexportbakeanim or len(names) > 1:
+            style.append("animation-timing-function: %s;\n" % ", ".join(timings))
+        return style
+
+    # Writes a file, along with precompressed copies if requested
+    def writeOutput(self, path, data, scene):
+        raw = data.encode('utf-8')
+        self.writeFile(path, raw)
+        
+        written = []
+        if scene.cssexportprecompress:
+            self.writeFile(path + ".gz", gzip.compress(raw, 9, mtime=0))
+            written.append(".gz")
+            if brotli != None:
+                self.writeFile(path + ".br", brotli.compress(raw, quality=11))
+                written.append(".br")
+        self.removeCompressed(path, written)
+    
+    # Drops precompressed copies left by earlier exports, which servers 
+    # would otherwise prefer over the fresh file
+    def removeCompressed(self, path, keep=[]):
+        for ext in (".gz", ".br"):
+            if not ext in keep and os.path.exists(path + ext):
+                os.remove(path + ext)
+    
+    # Writes via a temporary file so a failed export never leaves a partial file
+    def writeFile(self, path, raw):
+        tmpPath = path + ".tmp"
+        fs = open(tmpPath, "wb")
+        try:
+            fs.write(raw)
+        finally:
+            fs.close()
+        os.replace(tmpPath, path)
+
+    # Gets url for an image, embedding it when inlining and small enough
+    def imageURL(self, img, scene, classPath):
+        name = "%s.png" % bpy.path.ensure_ext(bpy.path.basename(img.filepath), '')
+        if not scene.cssexportinline:
+            return name
+        
+        # Prefer the image's own data, then a copy next to the export
+        data = None
+        mime = ImageMimeTypes.get(img.file_format)
+        source = bpy.path.abspath(img.filepath)
+        if img.packed_file != None:
+            data = img.packed_file.data
+        elif img.filepath and os.path.exists(source):
+            fs = open(source, "rb")
+            data = fs.read()
+            fs.close()
+        else:
+            source = "%s/%s" % (classPath, name)
+            mime = 'image/png'
+            if os.path.exists(source):
+                fs = open(source, "rb")
+                data = fs.read()
+                fs.close()
+        
+        if data == None or mime == None:
+            return name
+        if len(data) > scene.cssexportinlineimagelimit:
+            self.report({'WARNING'}, "Image %s is %i bytes, over the inline limit, leaving it external as %s" % (img.name, len(data), name))
+            return name
+        
+        return "data:%s;base64,%s" % (mime, base64.b64encode(data).decode('ascii'))
+
+    # Background for an image, sharing inlined data through a variable on #root
+    def imageBackground(self, img, scene, classPath):
+        if img.name in self.imageBackgrounds:
+            return self.imageBackgrounds[img.name]
+        
+        url = self.imageURL(img, scene, classPath)
+        if url.startswith("data:"):
+            var = "--img%i" % len(self.inlineImages)
+            self.inlineImages.append([var, url])
+            background = "var(%s)" % var
+        else:
+            background = "url(\"%s\")" % url
+        self.imageBackgrounds[img.name] = background
+        return background
+
+    def exportObjects(self, olist, doc, style, scene, classPath):
+        threedee = scene.cssexport3d
 
         for obj in olist:
             self.report({'INFO'}, "EXPORTING OBJECT %s" % obj.obj.name)
@@ -798,7 +2061,19 @@ class ExportCSSData(bpy.types.Operator):
             #
             #print "%s center=%s" % (obj.obj.getName(), str(obj.center))
             
-            style.append("transform: %s;\n" % obj.getTransform().transformValue(threedee))
+            anim = obj.anim
+            if scene.cssexportindividualtransforms and (anim == None or anim.channelsMatchTransform(threedee, scene.cssexportbakeanim)):
+                # Animated channels start from the first keyframe, static ones stay there
+                trans = obj.getTransform()
+                axis = None
+                if anim != None and len(anim.frames) > 0:
+                    trans = anim.frames[0][1]
+                    axis = self.rotationAxis(anim, scene)
+                values = trans.channelValues(threedee, axis)
+                for channel in SimpleTransform.CHANNELS:
+                    style.append("%s: %s;\n" % (channel, values[channel]))
+            else:
+                style.append("transform: %s;\n" % obj.getTransform().transformValue(threedee))
             
             if obj.mesh != None:
                 style.append("width: %dpx;\n" % (maxb[0] - minb[0]))
@@ -817,12 +2092,17 @@ class ExportCSSData(bpy.types.Operator):
                 mat = obj.material
                 self.report({'INFO'}, obj.material.blend_method)
 
+                # Animated colors start from the first keyframe
+                color = mat.diffuse_color
+                if obj.anim != None and obj.anim.animates_color and len(obj.anim.frames) > 0:
+                    color = obj.anim.frames[0][1].color
+
                 if obj.material.blend_method == 'OPAQUE':
                     # color
-                    style.append("background-color: rgb(%d,%d,%d);\n" % (mat.diffuse_color[0] * 255, mat.diffuse_color[1] * 255, mat.diffuse_color[2] * 255))
+                    style.append("background-color: %s;\n" % cssColor(color))
                     
-                if mat.diffuse_color[3] < 1.0:
-                    style.append("opacity: %f;\n" % mat.diffuse_color[3])
+                if color[3] < 1.0:
+                    style.append("opacity: %f;\n" % color[3])
                 
                 # Use any existing texture node to determine primary image
                 for node in mat.node_tree.nodes:
@@ -831,8 +2111,7 @@ class ExportCSSData(bpy.types.Operator):
                         img = node.image
                         if img != None:
                             # Image file
-                            name = img.filepath
-                            style.append("background-image: url(\"%s.png\");\n" % bpy.path.ensure_ext(bpy.path.basename(name), ''))
+                            style.append("background-image: %s;\n" % self.imageBackground(img, scene, classPath))
                             
                             # Background position
                             uv_min, uv_max = obj.getUVBounds()
@@ -853,33 +2132,24 @@ class ExportCSSData(bpy.types.Operator):
                             if oWidth != 1.0 or oHeight != 1.0:
                                 style.append("background-size: %.2f%% %.2f%%;\n" % (scale[0], scale[1]))
 
-            # animation
-            if obj.anim != None:
-                anim = obj.anim
-                
-                duration = anim.len / fps
-                delay = (anim.start-1) / fps
-                
-                style.append("animation-name: %s;\n" % anim.identifier)
-                style.append("animation-duration: %fs;\n" % duration)
-                style.append("animation-delay: %fs;\n" % delay)
-                
-                if scene.cssexportanimloop:
-                    style.append("animation-iteration-count: infinite;\n")
-                if scene.cssexportbakeanim:
-                    style.append("animation-timing-function: linear;\n")
+            # animation, which clips set up in their own stylesheets
+            if (obj.anim != None or obj.hasCullTrack()) and scene.cssexportclips == 'NONE':
+                style += self.animationStyle(obj, scene)
                 
             style.append("}\n")
             
+            if scene.cssexportclips == 'NONE':
+                style += self.overlayStyle(obj, "#%s" % obj.name, scene)
+            
             # Children are part of element
             if not scene.cssexportcollapsetransforms:
-                self.exportObjects(obj.children, doc, style, scene)
+                self.exportObjects(obj.children, doc, style, scene, classPath)
             
             doc.append("</div>\n")
             
             # Children are part of root
             if scene.cssexportcollapsetransforms:
-                self.exportObjects(obj.children, doc, style, scene)
+                self.exportObjects(obj.children, doc, style, scene, classPath)
 
 
 